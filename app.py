@@ -6,43 +6,384 @@ except ImportError:
     pass # Fallback to system sqlite3 if pysqlite3-binary is not found (e.g., local dev)
 import streamlit as st
 import os
-from crewai import Agent, Task, Crew, Process
+import logging
+from crewai import Agent, Task, Crew, Process, LLM
+from crewai.utilities.events import crewai_event_bus, LLMStreamChunkEvent
 from crewai_tools import SerperDevTool, ScrapeWebsiteTool, WebsiteSearchTool
+import requests
+from bs4 import BeautifulSoup
 from langchain_google_genai import ChatGoogleGenerativeAI
 from dotenv import load_dotenv
-import folium
-from streamlit_folium import st_folium
-from geopy.geocoders import Nominatim
-from geopy.exc import GeocoderTimedOut, GeocoderUnavailable
+import streamlit.components.v1 as components
+from concurrent.futures import ThreadPoolExecutor
 import litellm
 import re
+import queue
+import threading
+import time
+import hashlib
+import json
+import string
+import diskcache
+from collections import deque
 from io import BytesIO
-from xhtml2pdf import pisa
-import markdown
+# folium, geopy, markdown and the PDF engines are only needed once an itinerary exists,
+# so they are imported where they are used to keep the first page render fast.
 
-# Load environment variables from .env file
-load_dotenv()
+TARGET_GEMINI_MODEL = "gemini-1.5-flash-latest"
+# Per-role models: research gets the stronger models, while the cost template and the
+# final Markdown formatting run on the smaller, faster Flash-8B tier.
+ANALYST_GEMINI_MODEL = "gemini-1.5-pro-latest"
+ACTIVITY_GEMINI_MODEL = TARGET_GEMINI_MODEL
+COST_GEMINI_MODEL = "gemini-1.5-flash-8b-latest"
+SYNTH_GEMINI_MODEL = "gemini-1.5-flash-8b-latest"
+
+# Streamlit re-executes this script on every interaction; one-time process setup is cached.
+@st.cache_resource(show_spinner=False)
+def _init():
+    # Load environment variables from .env file
+    load_dotenv()
+
+    # Full prompt/response logging costs real time on long itineraries, so it is opt-in.
+    verbose = os.getenv("CREW_VERBOSE", "0") == "1"
+    if verbose:
+        os.environ['LITELLM_LOG'] = 'DEBUG'
+        litellm.set_verbose=True
+    else:
+        for logger_name in ("LiteLLM", "LiteLLM Router", "LiteLLM Proxy", "crewai"):
+            logging.getLogger(logger_name).setLevel(logging.WARNING)
+
+    for model_name in {ANALYST_GEMINI_MODEL, ACTIVITY_GEMINI_MODEL, COST_GEMINI_MODEL, SYNTH_GEMINI_MODEL}:
+        litellm.register_model({
+            model_name: {
+                "model_name": model_name, 
+                "litellm_provider": "gemini",       
+                "api_key": os.getenv("GEMINI_API_KEY"),
+                "api_base": "https://generativelanguage.googleapis.com/v1beta" 
+            },
+            # Fallback for the problematic "models/" prefix if LiteLLM internally generates it
+            f"models/{model_name}": {
+                "model_name": model_name,  
+                "litellm_provider": "gemini",
+                "api_key": os.getenv("GEMINI_API_KEY"),
+                "api_base": "https://generativelanguage.googleapis.com/v1beta"
+            }
+        })
+    return verbose
+
+VERBOSE = _init()
+
+# --- Gemini Rate Limiting ---
+# Free-tier quotas are per model, and LiteLLM's own retries often don't engage on
+# Gemini's RESOURCE_EXHAUSTED errors, so calls are spaced out here before they are sent.
+GEMINI_RPM_LIMIT = int(os.getenv("GEMINI_RPM_LIMIT", "15"))
+GEMINI_TPM_LIMIT = int(os.getenv("GEMINI_TPM_LIMIT", "1000000"))
+# model -> (requests/min, tokens/min); unlisted models use GEMINI_RPM_LIMIT / GEMINI_TPM_LIMIT.
+GEMINI_MODEL_LIMITS = {
+    "gemini-1.5-pro-latest": (2, 32000),
+    "gemini-1.5-flash-latest": (15, 1000000),
+    "gemini-1.5-flash-8b-latest": (15, 1000000),
+}
+GEMINI_MAX_RATE_LIMIT_RETRIES = 3
+_RETRY_DELAY_RE = re.compile(r'"retryDelay"\s*:\s*"(\d+(?:\.\d+)?)s"')
+
+class SlidingWindowRateLimiter:
+    """Keeps request and token counts within a 60 second sliding window."""
+
+    def __init__(self, rpm_limit, tpm_limit, window_seconds=60.0):
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self.window_seconds = window_seconds
+        self.request_times = deque()
+        self.token_usage = deque() # (timestamp, total_tokens)
+        self.lock = threading.Lock() # Async crew tasks call the LLM from worker threads
+
+    def _evict(self, now):
+        while self.request_times and now - self.request_times[0] >= self.window_seconds:
+            self.request_times.popleft()
+        while self.token_usage and now - self.token_usage[0][0] >= self.window_seconds:
+            self.token_usage.popleft()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._evict(now)
+                # Stay one request under larger ceilings to leave headroom for clock skew.
+                request_ceiling = self.rpm_limit - 1 if self.rpm_limit > 2 else self.rpm_limit
+                requests_full = len(self.request_times) >= request_ceiling
+                tokens_full = sum(tokens for _, tokens in self.token_usage) >= self.tpm_limit
+                if not requests_full and not tokens_full:
+                    self.request_times.append(now)
+                    return
+                oldest = self.request_times[0] if requests_full else self.token_usage[0][0]
+                wait_seconds = self.window_seconds - (now - oldest)
+            time.sleep(max(wait_seconds, 0.05))
+
+    def record_tokens(self, total_tokens):
+        with self.lock:
+            self.token_usage.append((time.monotonic(), total_tokens))
+
+def _retry_delay_seconds(error):
+    """Extracts google.rpc.RetryInfo.retryDelay from a 429 body, if the server sent one."""
+    match = _RETRY_DELAY_RE.search(str(error))
+    return float(match.group(1)) if match else None
+
+def _record_usage(limiter, usage):
+    if usage and getattr(usage, "total_tokens", None):
+        limiter.record_tokens(usage.total_tokens)
+
+def _usage_recording_stream(stream, limiter):
+    """Passes chunks through and records the usage LiteLLM attaches to the final chunk."""
+    last_usage = None
+    try:
+        for chunk in stream:
+            last_usage = getattr(chunk, "usage", None) or last_usage
+            yield chunk
+    finally:
+        _record_usage(limiter, last_usage)
+
+def _rate_limited(completion_fn):
+    limiters = {} # model name -> SlidingWindowRateLimiter
+    limiters_lock = threading.Lock()
+
+    def limiter_for(model):
+        model_name = model.split("/")[-1] # e.g. "gemini/gemini-1.5-pro-latest"
+        with limiters_lock:
+            if model_name not in limiters:
+                rpm_limit, tpm_limit = GEMINI_MODEL_LIMITS.get(model_name, (GEMINI_RPM_LIMIT, GEMINI_TPM_LIMIT))
+                limiters[model_name] = SlidingWindowRateLimiter(rpm_limit, tpm_limit)
+            return limiters[model_name]
+
+    def rate_limited_completion(*args, **kwargs):
+        limiter = limiter_for(kwargs.get("model") or (args[0] if args else ""))
+        streaming = bool(kwargs.get("stream"))
+        if streaming and not kwargs.get("stream_options"):
+            kwargs["stream_options"] = {"include_usage": True} # Streamed tokens count towards TPM too
+        for attempt in range(GEMINI_MAX_RATE_LIMIT_RETRIES + 1):
+            limiter.acquire()
+            try:
+                response = completion_fn(*args, **kwargs)
+            except litellm.RateLimitError as e:
+                if attempt == GEMINI_MAX_RATE_LIMIT_RETRIES:
+                    raise
+                time.sleep(_retry_delay_seconds(e) or 2 ** (attempt + 1))
+                continue
+            if streaming:
+                return _usage_recording_stream(response, limiter)
+            _record_usage(limiter, getattr(response, "usage", None))
+            return response
+    rate_limited_completion._rate_limited = True
+    return rate_limited_completion
+
+# Streamlit re-executes this module on every rerun; wrap litellm.completion only once.
+if not getattr(litellm.completion, "_rate_limited", False):
+    litellm.completion = _rate_limited(litellm.completion)
+
+# --- Disk Caches ---
+# Opening a diskcache sets up its SQLite store, so each directory is opened once per process.
+@st.cache_resource(show_spinner=False)
+def get_disk_cache(directory):
+    return diskcache.Cache(directory)
+
+# --- Geocoding Cache ---
+# Landmarks repeat across itineraries, so coordinates are persisted on disk and
+# only cache misses reach the geocoding service.
+GEOCODE_CACHE_TTL_SECONDS = 30 * 86400
+geocode_cache = get_disk_cache(".geocache")
+_CACHE_MISS = object()
+_PUNCTUATION_TABLE = str.maketrans("", "", string.punctuation)
+
+def cached_geocode(loc_name, geocode_fn):
+    """Returns (lat, lon) for loc_name, or None if the geocoder found nothing."""
+    normalized_name = " ".join(loc_name.translate(_PUNCTUATION_TABLE).lower().split())
+    cache_key = hashlib.sha256(normalized_name.encode("utf-8")).hexdigest()
+    cached_value = geocode_cache.get(cache_key, default=_CACHE_MISS)
+    if cached_value is not _CACHE_MISS:
+        return cached_value
+    location_geo = geocode_fn(loc_name, timeout=10)
+    coords = (location_geo.latitude, location_geo.longitude) if location_geo else None
+    geocode_cache.set(cache_key, coords, expire=GEOCODE_CACHE_TTL_SECONDS)
+    return coords
+
+# --- Geocoder Providers ---
+# GEOCODER_PROVIDER picks the first provider tried; later ones in its chain are fallbacks.
+# Nominatim's TOS caps it at 1 req/s, so OpenCage (API key) or Photon lift the ceiling.
+GEOCODER_PROVIDER = os.getenv("GEOCODER_PROVIDER", "nominatim").lower()
+GEOCODER_USER_AGENT = "travel_planner_app/1.0"
+_GEOCODER_FALLBACK_CHAINS = {
+    "opencage": ["opencage", "photon", "nominatim"],
+    "photon": ["photon", "nominatim"],
+    "nominatim": ["nominatim"],
+}
+# provider -> (min delay between requests in seconds, thread pool size)
+_GEOCODER_LIMITS = {
+    "opencage": (0.0, 10),
+    "photon": (0.1, 5),
+    "nominatim": (1.0, 5),
+}
+
+def _build_geocoder(provider):
+    from geopy.adapters import RequestsAdapter
+    from geopy.geocoders import Nominatim, OpenCage, Photon
+
+    # RequestsAdapter keeps one pooled session alive across lookups.
+    if provider == "opencage":
+        return OpenCage(api_key=os.getenv("OPENCAGE_KEY"), user_agent=GEOCODER_USER_AGENT, adapter_factory=RequestsAdapter)
+    if provider == "photon":
+        return Photon(user_agent=GEOCODER_USER_AGENT, adapter_factory=RequestsAdapter)
+    return Nominatim(user_agent=GEOCODER_USER_AGENT, adapter_factory=RequestsAdapter)
+
+@st.cache_resource(show_spinner=False)
+def build_geocode_fn():
+    """Returns (geocode_fn, max_workers) for the configured provider and its fallback chain.
+
+    Cached per process so every session shares one pooled session and RateLimiter per provider.
+    """
+    from geopy.exc import GeocoderServiceError
+    from geopy.extra.rate_limiter import RateLimiter
+
+    chain = _GEOCODER_FALLBACK_CHAINS.get(GEOCODER_PROVIDER, _GEOCODER_FALLBACK_CHAINS["nominatim"])
+    if not os.getenv("OPENCAGE_KEY"):
+        chain = [provider for provider in chain if provider != "opencage"]
+    # Each RateLimiter keeps concurrent workers within that provider's request policy.
+    geocoders = [
+        RateLimiter(_build_geocoder(provider).geocode, min_delay_seconds=_GEOCODER_LIMITS[provider][0], max_retries=2, swallow_exceptions=False)
+        for provider in chain
+    ]
+
+    def geocode_with_fallback(loc_name, timeout=10):
+        last_error = None
+        for geocode in geocoders:
+            try:
+                location_geo = geocode(loc_name, timeout=timeout)
+            except GeocoderServiceError as e:
+                last_error = e
+                continue
+            if location_geo:
+                return location_geo
+        if last_error:
+            raise last_error
+        return None
 
-os.environ['LITELLM_LOG'] = 'DEBUG'
-litellm.set_verbose=True 
+    return geocode_with_fallback, _GEOCODER_LIMITS[chain[0]][1]
 
-TARGET_GEMINI_MODEL = "gemini-1.5-flash-latest"
+# --- Key Locations Parsing ---
+KEY_LOCATIONS_MARKER = "Key Locations for Map:"
+_BULLET_RE = re.compile(r"^\s*[-*•\s]+")
+# Matches the "<lat>, <lon>" half of "<name> | <lat>, <lon>" bullets, in decimal degrees
+# with optional degree signs and N/S/E/W hemispheres (e.g. "48.8584° N, 2.2945° E").
+_LANDMARK_COORDS_RE = re.compile(r"^\s*(-?\d+(?:\.\d+)?)\s*°?\s*([NS])?\s*,\s*(-?\d+(?:\.\d+)?)\s*°?\s*([EW])?\s*$", re.IGNORECASE)
 
-litellm.register_model({
-    TARGET_GEMINI_MODEL: {
-        "model_name": TARGET_GEMINI_MODEL, 
-        "litellm_provider": "gemini",       
-        "api_key": os.getenv("GEMINI_API_KEY"),
-        "api_base": "https://generativelanguage.googleapis.com/v1beta" 
-    },
-    # Fallback for the problematic "models/" prefix if LiteLLM internally generates it
-    f"models/{TARGET_GEMINI_MODEL}": {
-        "model_name": TARGET_GEMINI_MODEL,  
-        "litellm_provider": "gemini",
-        "api_key": os.getenv("GEMINI_API_KEY"),
-        "api_base": "https://generativelanguage.googleapis.com/v1beta"
+def parse_inline_coords(coords_text):
+    """Returns (lat, lon) from the text after a bullet's "|", or None if it isn't usable."""
+    coords_match = _LANDMARK_COORDS_RE.match(coords_text)
+    if not coords_match:
+        return None
+    lat, lat_hemisphere, lon, lon_hemisphere = coords_match.groups()
+    lat, lon = float(lat), float(lon)
+    if lat_hemisphere and lat_hemisphere.upper() == "S":
+        lat = -abs(lat)
+    if lon_hemisphere and lon_hemisphere.upper() == "W":
+        lon = -abs(lon)
+    if -90 <= lat <= 90 and -180 <= lon <= 180:
+        return lat, lon
+    return None
+
+# --- Preloaded Landmarks ---
+# Most trips target a small set of popular cities, so their centers and best-known landmarks
+# ship with the app (landmarks.json) and resolve without any network call.
+LANDMARKS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "landmarks.json")
+
+def _landmark_key(name):
+    return " ".join(name.lower().split())
+
+@st.cache_resource(show_spinner=False)
+def load_landmark_table():
+    """Returns the normalized landmarks.json sections.
+
+    "cities" and "landmarks" map names to (lat, lon); "city_countries" and "country_aliases"
+    say which trailing country a bundled city may be qualified with.
+    """
+    try:
+        with open(LANDMARKS_PATH, encoding="utf-8") as f:
+            raw_table = json.load(f)
+    except (OSError, ValueError):
+        raw_table = {}
+    table = {
+        section: {_landmark_key(name): tuple(coords) for name, coords in raw_table.get(section, {}).items()}
+        for section in ("cities", "landmarks")
     }
-})
+    for section in ("city_countries", "country_aliases"):
+        table[section] = {_landmark_key(name): _landmark_key(value) for name, value in raw_table.get(section, {}).items()}
+    return table
+
+def lookup_known_coords(name, section="landmarks"):
+    """Matches name exactly, or with a trailing country that the bundled city belongs to.
+
+    Any other trailing part (e.g. "Paris, Texas") is a different place and doesn't match.
+    """
+    table = load_landmark_table()
+    entries = table[section]
+    key = _landmark_key(name)
+    if key in entries:
+        return entries[key]
+    head, _, dropped = key.rpartition(",")
+    head, dropped = head.strip(), dropped.strip()
+    if head not in entries:
+        return None
+    city = head if section == "cities" else head.rsplit(",", 1)[-1].strip()
+    city_country = table["city_countries"].get(city)
+    if city_country and table["country_aliases"].get(dropped, dropped) == city_country:
+        return entries[head]
+    return None
+
+def iter_landmarks(text):
+    """Yields (name, (lat, lon) or None) for each bullet in the itinerary's Key Locations section."""
+    marker_idx = text.rfind(KEY_LOCATIONS_MARKER)
+    if marker_idx >= 0:
+        lines_to_parse = text[marker_idx + len(KEY_LOCATIONS_MARKER):].splitlines()
+    else:
+        lines_to_parse = text.strip().splitlines()[-10:] # Fallback
+    for line in lines_to_parse:
+        # Only the part before "|" is the name, even when the coordinates after it don't parse.
+        name, has_coords, coords_text = _BULLET_RE.sub("", line).partition("|")
+        name = name.strip()
+        inline_coords = parse_inline_coords(coords_text) if has_coords else None
+        if len(name) > 3: # Basic check for valid location name
+            # Preloaded coordinates win over the LLM's; either one skips the geocoder entirely.
+            yield name, lookup_known_coords(name) or inline_coords
+
+def resolve_landmark(landmark, geocode_fn):
+    """Returns (name, coords, error); errors are returned so the script thread can report them."""
+    name, coords = landmark
+    if coords:
+        return name, coords, None
+    try:
+        return name, cached_geocode(name, geocode_fn), None
+    except Exception as e:
+        return name, None, e
+
+# --- Itinerary Cache ---
+# Identical trip requests reuse the finished itinerary, and the destination analysis
+# is shared across requests for the same destination regardless of interests/budget.
+ITINERARY_CACHE_TTL_SECONDS = 7 * 86400
+itinerary_cache = get_disk_cache("./itinerary_cache")
+
+def _normalize_cache_text(text):
+    return " ".join(text.lower().split())
+
+def itinerary_cache_key(travel_inputs):
+    # Case, spacing and the order interests were picked in don't change the trip.
+    normalized_inputs = {key: _normalize_cache_text(value) for key, value in travel_inputs.items()}
+    normalized_inputs['interests'] = sorted(
+        _normalize_cache_text(interest) for interest in travel_inputs['interests'].split(",") if interest.strip()
+    )
+    return "itinerary:" + hashlib.sha256(json.dumps(normalized_inputs, sort_keys=True).encode("utf-8")).hexdigest()
+
+def destination_analysis_cache_key(destination):
+    normalized_destination = _normalize_cache_text(destination)
+    return "destination_analysis:" + hashlib.sha256(normalized_destination.encode("utf-8")).hexdigest()
 
 st.set_page_config(page_title="AI Travel Planner", layout="wide")
 
@@ -67,59 +408,248 @@ if not serper_api_key_set:
     st.sidebar.warning("🟡 SERPER_API_KEY environment variable not set. Search quality might be reduced.")
 
 # --- Initialize Tools ---
-try:
-    if serper_api_key_set:
-        search_tool = SerperDevTool()
-    else:
-        search_tool = WebsiteSearchTool()
-        st.warning("⚠️ Serper API key not found, using WebsiteSearchTool (DuckDuckGo) as fallback.")
-except Exception as e:
-    st.error(f"❌ Failed to initialize search tool: {e}. Please check API keys/internet.")
-    search_tool = WebsiteSearchTool() # Fallback
-
-scrape_tool = ScrapeWebsiteTool()
-
-# --- Define Agents Globally ---
-# Define the LLM identifier string for CrewAI agents
-agent_llm_identifier = f"gemini/{TARGET_GEMINI_MODEL}"
-
-destination_analyst = Agent(
-    role='Lead Destination Analyst',
-    goal='Gather key facts, cultural insights, must-see general attractions, safety tips, key local emergency contact numbers (e.g., police, ambulance, general emergency), 3-5 basic local phrases (e.g., hello, thank you, goodbye with simple phonetic pronunciations if possible), and 1-2 crucial cultural etiquette tips for {destination}.',
-    backstory='You are a seasoned travel writer with an encyclopedic knowledge of global destinations, always ensuring travelers are well-informed with practical cultural nuances.',
-    verbose=True,
-    allow_delegation=False,
-    tools=[search_tool, scrape_tool],
-    llm=agent_llm_identifier
-)
-
-activity_interest_specialist = Agent(
-    role='Activity and Interest Specialist',
-    goal='Based on user interests ({interests}) and budget ({budget_level}), find specific activities, attractions, restaurants, and experiences in {destination}.',
-    backstory='You have a knack for finding unique and fitting experiences that match individual tastes and budgets, from hidden gems to popular hotspots.',
-    verbose=True,
-    allow_delegation=False,
-    tools=[search_tool, scrape_tool],
-    llm=agent_llm_identifier
-)
-
-itinerary_synthesizer = Agent(
-    role='Master Itinerary Planner',
-    goal='Create a balanced, exciting, and practical day-by-day travel itinerary for {duration_of_trip} in {destination}. The itinerary must incorporate user interests ({interests}), consider the {budget_level}, and be logically structured. It should also identify 3-5 key landmarks or points of interest from the itinerary and list them clearly for map plotting. Output in Markdown format.',
-    backstory='You are an expert travel planner renowned for crafting memorable and practical itineraries that flow smoothly and maximize enjoyment.',
-    verbose=True,
-    allow_delegation=False,
-    llm=agent_llm_identifier
-)
-
-cost_estimator_agent = Agent(
-    role='Travel Cost Estimator',
-    goal='Provide a rough daily and total trip cost estimation in INR (Indian Rupees) based on the destination ({destination}), trip duration ({duration_of_trip}), user\'s budget level ({budget_level}), and the types of activities planned. Clearly state that these are estimates. Do not look up real-time prices; use general knowledge for estimations.',
-    backstory='You are an experienced travel budget advisor who can provide reasonable cost estimates for various travel styles and destinations, helping travelers plan their finances.',
-    verbose=True,
-    allow_delegation=False,
-    llm=agent_llm_identifier
-)
+# Both research agents often issue overlapping searches and scrapes, so tool results are
+# cached on disk by tool name and arguments, sparing HTTP round-trips and Serper quota.
+TOOL_CACHE_TTL_SECONDS = 86400
+tool_cache = get_disk_cache(".tool_cache")
+
+class _DiskCachedToolMixin:
+    def _run(self, **kwargs):
+        cache_key = f"{self.name}:" + hashlib.sha256(json.dumps(kwargs, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        cached_value = tool_cache.get(cache_key, default=_CACHE_MISS)
+        if cached_value is not _CACHE_MISS:
+            return cached_value
+        result, cacheable = self._fetch(**kwargs)
+        if cacheable:
+            tool_cache.set(cache_key, result, expire=TOOL_CACHE_TTL_SECONDS)
+        return result
+
+    def _fetch(self, **kwargs):
+        """Returns (result, cacheable); failures must not be cached for later runs."""
+        return super()._run(**kwargs), True
+
+class CachedSerperDevTool(_DiskCachedToolMixin, SerperDevTool):
+    pass # SerperDevTool raises on non-2xx responses, so whatever it returns is cacheable
+
+class CachedScrapeWebsiteTool(_DiskCachedToolMixin, ScrapeWebsiteTool):
+    def _fetch(self, **kwargs):
+        # ScrapeWebsiteTool._run returns error and bot-challenge pages as ordinary text, so the
+        # request is made here to see the status code before anything is cached.
+        # Mirrors ScrapeWebsiteTool._run from crewai-tools==0.47.1 (request, encoding, parsing and
+        # whitespace cleanup); re-sync it when bumping crewai-tools.
+        website_url = kwargs.get("website_url", self.website_url)
+        page = requests.get(website_url, timeout=15, headers=self.headers, cookies=self.cookies or {})
+        if not 200 <= page.status_code < 300:
+            return f"Could not read {website_url}: HTTP {page.status_code}.", False
+        page.encoding = page.apparent_encoding
+        text = BeautifulSoup(page.text, "html.parser").get_text(" ")
+        text = re.sub("[ \t]+", " ", text)
+        text = re.sub("\\s+\n\\s+", "\n", text)
+        return text, True
+
+@st.cache_resource(show_spinner=False)
+def get_tools(use_serper):
+    """Returns (search_tool, scrape_tool, init_error); the tools are shared across sessions."""
+    init_error = None
+    try:
+        search_tool = CachedSerperDevTool() if use_serper else WebsiteSearchTool()
+    except Exception as e:
+        init_error = e
+        search_tool = WebsiteSearchTool() # Fallback
+    return search_tool, CachedScrapeWebsiteTool(), init_error
+
+search_tool, scrape_tool, tool_init_error = get_tools(serper_api_key_set)
+if tool_init_error:
+    st.error(f"❌ Failed to initialize search tool: {tool_init_error}. Please check API keys/internet.")
+elif not serper_api_key_set:
+    st.warning("⚠️ Serper API key not found, using WebsiteSearchTool (DuckDuckGo) as fallback.")
+
+# --- Define Agents (built once per session) ---
+# Define the LLM identifier strings for CrewAI agents
+ANALYST_LLM = f"gemini/{ANALYST_GEMINI_MODEL}"
+ACTIVITY_LLM = f"gemini/{ACTIVITY_GEMINI_MODEL}"
+COST_LLM = f"gemini/{COST_GEMINI_MODEL}"
+SYNTH_LLM = f"gemini/{SYNTH_GEMINI_MODEL}"
+
+def build_agents(tools):
+    """Agents carry per-run state (interpolated goals, executors), so each session gets its own set."""
+    # Only the synthesizer streams: its output is the one the user reads, while the
+    # upstream agents' outputs are consumed by other agents.
+    synth_llm = LLM(model=SYNTH_LLM, stream=True)
+
+    destination_analyst = Agent(
+        role='Lead Destination Analyst',
+        goal='Brief travelers on the essentials, culture and safety of {destination}.',
+        backstory='A seasoned travel writer with encyclopedic knowledge of global destinations.',
+        verbose=VERBOSE,
+        allow_delegation=False,
+        tools=list(tools),
+        llm=ANALYST_LLM
+    )
+
+    activity_interest_specialist = Agent(
+        role='Activity and Interest Specialist',
+        goal='Find activities and dining in {destination} matching {interests} on a {budget_level} budget.',
+        backstory='An expert at matching experiences, from hidden gems to hotspots, to tastes and budgets.',
+        verbose=VERBOSE,
+        allow_delegation=False,
+        tools=list(tools),
+        llm=ACTIVITY_LLM
+    )
+
+    itinerary_synthesizer = Agent(
+        role='Master Itinerary Planner',
+        goal='Turn the research into a practical day-by-day {duration_of_trip} itinerary for {destination}.',
+        backstory='An expert travel planner known for itineraries that flow smoothly.',
+        verbose=VERBOSE,
+        allow_delegation=False,
+        llm=synth_llm
+    )
+
+    cost_estimator_agent = Agent(
+        role='Travel Cost Estimator',
+        goal='Estimate daily and total trip costs in INR for {duration_of_trip} in {destination} at a {budget_level} level from general knowledge.',
+        backstory='An experienced travel budget advisor.',
+        verbose=VERBOSE,
+        allow_delegation=False,
+        llm=COST_LLM
+    )
+
+    return destination_analyst, activity_interest_specialist, cost_estimator_agent, itinerary_synthesizer
+
+if 'agents' not in st.session_state:
+    st.session_state.agents = build_agents((search_tool, scrape_tool))
+destination_analyst, activity_interest_specialist, cost_estimator_agent, itinerary_synthesizer = st.session_state.agents
+
+# --- Task Prompts ---
+# Shared by the crew tasks and batch mode so both send the same instructions.
+TASK_PROMPTS = {
+    'destination_analysis': {
+        'description': 'Analyze {destination} for travelers.',
+        'expected_output': 'A summary of {destination}: main attractions, cultural norms, best times to visit, travel tips, local emergency numbers (police, ambulance, general), 3-5 basic phrases with simple pronunciations, and 1-2 key etiquette tips.',
+    },
+    'activity_research': {
+        'description': 'Research activities, sights and dining in {destination} for interests: {interests}; budget: {budget_level}.',
+        'expected_output': '5-7 varied activities, sights and dining options, each with a brief description.',
+    },
+    'cost_estimation': {
+        'description': 'Estimate food, local transport and minor activity costs for {duration_of_trip} in {destination} at a {budget_level} level, excluding international flights and accommodation.',
+        'expected_output': 'Exactly two lines: "Estimated Daily Cost (INR): <range>" and "Estimated Total Trip Cost (INR, excluding major transit/accommodation): <range>".',
+    },
+    'itinerary_generation': {
+        'description': 'Compile a {duration_of_trip} itinerary for {destination} (interests: {interests}; budget: {budget_level}) from the research, analysis and cost estimates.',
+        'expected_output': (
+            'A Markdown itinerary with Morning/Afternoon/Evening per day, then sections "Useful Phrases & Etiquette", "Important Contacts" and "Budget & Cost Estimates". End with:\n\n'
+            'Key Locations for Map:\n'
+            '- <Landmark>, <City> | <lat>, <lon>\n'
+            '- ...\n'
+            '(3-5 bullets, mandatory, absolute last lines)'
+        ),
+    },
+}
+
+# --- Streaming Kickoff Helper ---
+FINAL_ANSWER_MARKER = "Final Answer:"
+
+@st.cache_resource(show_spinner=False)
+def get_stream_queues():
+    """Registers one process-wide stream handler that routes chunks to the queue registered for their LLM."""
+    stream_queues = {} # id(LLM) -> queue.Queue
+    @crewai_event_bus.on(LLMStreamChunkEvent)
+    def on_stream_chunk(source, event):
+        chunk_queue = stream_queues.get(id(source))
+        if chunk_queue is not None:
+            chunk_queue.put(event.chunk)
+    return stream_queues
+
+def kickoff_with_stream(crew, inputs, placeholder, stream_llm):
+    """Runs crew.kickoff in a worker thread while streaming stream_llm's tokens into placeholder."""
+    chunk_queue = queue.Queue()
+    outcome = {}
+    done = object()
+
+    def run_crew():
+        try:
+            outcome["result"] = crew.kickoff(inputs=inputs)
+        except Exception as e:
+            outcome["error"] = e
+        finally:
+            chunk_queue.put(done)
+
+    def chunk_gen():
+        # The raw completion is CrewAI's ReAct text ("Thought: ... Final Answer: ..."); only the
+        # part after the marker is the itinerary, so everything before it is held back.
+        pending = ""
+        answer_started = False
+        while (chunk := chunk_queue.get()) is not done:
+            if answer_started:
+                yield chunk
+                continue
+            pending += chunk
+            marker_idx = pending.find(FINAL_ANSWER_MARKER)
+            if marker_idx >= 0:
+                answer_started = True
+                answer_start = pending[marker_idx + len(FINAL_ANSWER_MARKER):].lstrip()
+                if answer_start:
+                    yield answer_start
+
+    stream_queues = get_stream_queues()
+    stream_queues[id(stream_llm)] = chunk_queue
+    try:
+        worker = threading.Thread(target=run_crew, daemon=True)
+        worker.start()
+        # st.write_stream must run on the script thread, so it drains the queue here.
+        placeholder.write_stream(chunk_gen())
+        worker.join()
+    finally:
+        stream_queues.pop(id(stream_llm), None)
+
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["result"]
+
+# --- Gemini Batch Mode ---
+# Batch jobs cost about half as much as online calls but may take hours to finish, so
+# they are opt-in. The Batch API serves current models only, hence its own model.
+BATCH_GEMINI_MODEL = "gemini-2.5-flash"
+BATCH_POLL_SECONDS = 30
+_BATCH_DONE_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+# Stage 1 tasks are primed only with the user's inputs; stage 2 (the itinerary) gets their outputs.
+BATCH_STAGE_1_TASKS = ['destination_analysis', 'activity_research', 'cost_estimation']
+
+@st.cache_resource(show_spinner=False)
+def get_genai_client():
+    from google import genai # Only needed once batch mode is used
+
+    return genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+
+def _batch_request(task_key, inputs, context_outputs):
+    prompt = TASK_PROMPTS[task_key]
+    text = f"{prompt['description']}\n\nExpected output: {prompt['expected_output']}".format(**inputs)
+    for context_key, output in context_outputs.items():
+        text += f"\n\n{context_key.replace('_', ' ').capitalize()}:\n{output}"
+    return {"contents": [{"parts": [{"text": text}], "role": "user"}]}
+
+def submit_batch(task_keys, inputs, context_outputs=None):
+    """Submits one inline batch job with a request per task and returns the job name."""
+    job = get_genai_client().batches.create(
+        model=BATCH_GEMINI_MODEL,
+        src=[_batch_request(task_key, inputs, context_outputs or {}) for task_key in task_keys],
+        config={"display_name": f"travel-planner-{task_keys[-1]}"},
+    )
+    return job.name
+
+def collect_batch_outputs(job, task_keys):
+    """Maps task keys to response text; inline responses come back in request order."""
+    outputs = {}
+    for task_key, inlined in zip(task_keys, job.dest.inlined_responses):
+        if inlined.error:
+            raise RuntimeError(f"Batch request for {task_key} failed: {inlined.error}")
+        text = inlined.response.text if inlined.response else None
+        if not text: # No text candidate, e.g. a safety-blocked response
+            raise RuntimeError(f"Batch request for {task_key} returned no text.")
+        outputs[task_key] = text
+    return outputs
 
 # --- Streamlit Input Widgets ---
 st.sidebar.header("🌍 Plan Your Trip!")
@@ -131,72 +661,100 @@ selected_interests = st.sidebar.multiselect("Your Interests", interest_options)
 interests_string = ", ".join(selected_interests)
 
 budget_level = st.sidebar.selectbox("Budget Level", ["Budget-Friendly", "Mid-Range", "Luxury"], index=1)
+force_regenerate = st.sidebar.checkbox("🔄 Force regenerate (ignore cached results)")
+use_batch = st.sidebar.checkbox("🕒 Batch mode (cheaper, slower)")
+
+travel_inputs = {
+    'destination': destination,
+    'duration_of_trip': duration_of_trip,
+    'interests': interests_string,
+    'budget_level': budget_level
+}
 
 if st.sidebar.button("✨ Generate Itinerary"):
     if not gemini_api_key_env: # Check if API key is present
         st.error("🔴 GEMINI_API_KEY not found. Cannot start. Please ensure GEMINI_API_KEY is set in your .env file and is valid.")
     elif not destination or not duration_of_trip or not interests_string:
         st.warning("⚠️ Please fill in all travel details (Destination, Duration, Interests).")
+    elif not force_regenerate and (cached_itinerary := itinerary_cache.get(itinerary_cache_key(travel_inputs))):
+        st.success("✅ Loaded your itinerary from cache!")
+        st.markdown("---")
+        st.session_state.current_itinerary = cached_itinerary
+        st.session_state.original_inputs = travel_inputs
+    elif use_batch:
+        cached_analysis = None if force_regenerate else itinerary_cache.get(destination_analysis_cache_key(destination))
+        batch_outputs = {'destination_analysis': cached_analysis} if cached_analysis else {}
+        batch_task_keys = [task_key for task_key in BATCH_STAGE_1_TASKS if task_key not in batch_outputs]
+        try:
+            st.session_state.batch_job = {
+                'name': submit_batch(batch_task_keys, travel_inputs),
+                'stage': 1,
+                'task_keys': batch_task_keys,
+                'inputs': travel_inputs,
+                'outputs': batch_outputs,
+            }
+        except Exception as e:
+            st.error(f"An error occurred while submitting the batch job: {e}")
     else:
         st.info(f"🚀 Crafting your personalized itinerary for {destination}...")
         st.info("Please wait, this may take a few minutes (or more for complex trips)...")
 
+        # A cached destination analysis replaces its task; downstream tasks receive it as an input instead of as context.
+        analysis_key = destination_analysis_cache_key(destination)
+        cached_analysis = None if force_regenerate else itinerary_cache.get(analysis_key)
+        crew_inputs = dict(travel_inputs)
+        if cached_analysis:
+            crew_inputs['destination_analysis'] = cached_analysis
+            analysis_note = ' Destination analysis from a previous run:\n{destination_analysis}'
+        else:
+            analysis_note = ''
+
         # --- Define Tasks (Inside button click) ---
         destination_analysis_task = Task(
-            description='Conduct a comprehensive analysis of {destination}. Gather information on its main attractions, cultural norms, best times to visit, essential travel tips, key local emergency contact numbers (e.g., police, ambulance, general emergency line), 3-5 basic local phrases (like hello, thank you, please, excuse me, goodbye - include simple phonetic pronunciation if available), and 1-2 crucial cultural etiquette tips.',
-            expected_output='A summary report on {destination}, including key attractions, cultural notes, travel advice, a list of key local emergency contact numbers, a clearly formatted list of 3-5 basic local phrases with simple pronunciations, and 1-2 important cultural etiquette tips.',
+            **TASK_PROMPTS['destination_analysis'],
             agent=destination_analyst
         )
+        upstream_context = [] if cached_analysis else [destination_analysis_task]
 
         activity_research_task = Task(
-            description='Research and identify specific activities, sights, and dining options in {destination} that align with the user\'s interests: {interests} and budget: {budget_level}. Provide a list of at least 5-7 varied suggestions with brief descriptions.',
-            expected_output='A curated list of 5-7 activities, sights, and dining options with descriptions, tailored to user preferences and budget.',
+            description=TASK_PROMPTS['activity_research']['description'] + analysis_note,
+            expected_output=TASK_PROMPTS['activity_research']['expected_output'],
             agent=activity_interest_specialist,
-            context=[destination_analysis_task]
+            context=upstream_context,
+            async_execution=True # Runs alongside cost estimation; both only need the destination analysis
         )
 
         cost_estimation_task = Task(
-            description='Based on the destination ({destination}), trip duration ({duration_of_trip}), user\'s budget level ({budget_level}), and a general understanding of the types of activities likely to be included (from destination analysis and activity research), provide a rough daily cost estimate and a total trip estimate, both in INR (Indian Rupees). These estimates should cover typical expenses like food, local transport, and minor activities, excluding major international flights and pre-booked accommodation unless specified by the budget level. Clearly label these as "Estimated Daily Cost (INR)" and "Estimated Total Trip Cost (INR, excluding major transit/accommodation)".',
-            expected_output='A short section with "Estimated Daily Cost (INR): [Amount Range in INR]" and "Estimated Total Trip Cost (INR, excluding major transit/accommodation): [Amount Range in INR]". For example: "Estimated Daily Cost (INR): ₹3000-₹5000. Estimated Total Trip Cost (INR, excluding major transit/accommodation): ₹15000-₹25000 for 5 days."',
-            agent=cost_estimator_agent
+            description=TASK_PROMPTS['cost_estimation']['description'] + analysis_note,
+            expected_output=TASK_PROMPTS['cost_estimation']['expected_output'],
+            agent=cost_estimator_agent,
+            context=upstream_context,
+            async_execution=True
         )
 
         itinerary_generation_task = Task(
-            description=(
-                'Compile a detailed day-by-day Markdown itinerary for a {duration_of_trip} trip to {destination}, based on destination analysis and activity research. '
-                'The itinerary should be engaging, practical (considering travel times between activities if possible), and cater to the user\'s interests: {interests} and budget: {budget_level}. '
-                'Also, include the basic local phrases, cultural etiquette tips, and emergency contact numbers obtained from the destination analysis (available in its output) in clearly marked sections (e.g., "Useful Phrases & Etiquette", "Important Contacts") for easy reference. '
-                'Incorporate the cost estimation (from the Cost Estimation Task output) into a dedicated "Budget & Cost Estimates" section. '
-                'CRITICALLY IMPORTANT: The entire response MUST end with a section starting with the exact, case-sensitive heading: "Key Locations for Map:". '
-                'Immediately following this "Key Locations for Map:" heading, list 3-5 prominent landmarks as bullet points. Example of this final section:\n'
-                'Key Locations for Map:\n'
-                '- Eiffel Tower, Paris\n'
-                '- Louvre Museum, Paris\n'
-                'Failure to include the "Key Locations for Map:" heading precisely as written, or placing any content after it, will prevent map generation. This section is mandatory and must be the absolute final part of your output. '
-                'The main itinerary part should be structured clearly for each day (e.g., Morning, Afternoon, Evening). Format the entire output as a single Markdown string.'
-            ),
-            expected_output='A complete, day-by-day travel itinerary in Markdown format, detailing suggested activities, sights, and potentially meal spots for each part of the day. The output should also prominently feature: an "Important Contacts" section, a "Useful Phrases & Etiquette" section, a "Budget & Cost Estimates" section, and finally, a "Key Locations for Map:" section with 3-5 listed locations.',
+            description=TASK_PROMPTS['itinerary_generation']['description'] + analysis_note,
+            expected_output=TASK_PROMPTS['itinerary_generation']['expected_output'],
             agent=itinerary_synthesizer,
-            context=[destination_analysis_task, activity_research_task, cost_estimation_task]
+            context=upstream_context + [activity_research_task, cost_estimation_task]
         )
 
         travel_crew = Crew(
-            agents=[destination_analyst, activity_interest_specialist, cost_estimator_agent, itinerary_synthesizer],
-            tasks=[destination_analysis_task, activity_research_task, cost_estimation_task, itinerary_generation_task],
-            process=Process.sequential,
-            verbose=True
+            agents=([] if cached_analysis else [destination_analyst]) + [activity_interest_specialist, cost_estimator_agent, itinerary_synthesizer],
+            tasks=upstream_context + [activity_research_task, cost_estimation_task, itinerary_generation_task],
+            process=Process.sequential, # The synchronous itinerary task waits for both async branches
+            verbose=VERBOSE
         )
 
         with st.spinner("🌍 Agents are exploring and planning..."):
-            travel_inputs = {
-                'destination': destination,
-                'duration_of_trip': duration_of_trip,
-                'interests': interests_string,
-                'budget_level': budget_level
-            }
+            stream_placeholder = st.empty()
             try:
-                result_object = travel_crew.kickoff(inputs=travel_inputs)
+                result_object = kickoff_with_stream(travel_crew, crew_inputs, stream_placeholder, itinerary_synthesizer.llm)
                 result = result_object.raw # Access the raw string output
+                itinerary_cache.set(itinerary_cache_key(travel_inputs), result, expire=ITINERARY_CACHE_TTL_SECONDS)
+                if not cached_analysis:
+                    itinerary_cache.set(analysis_key, destination_analysis_task.output.raw, expire=ITINERARY_CACHE_TTL_SECONDS)
+                stream_placeholder.empty() # The final itinerary is rendered below
 
                 st.success("✅ Your Personalized Itinerary is Ready!")
                 st.markdown("---")
@@ -206,6 +764,57 @@ if st.sidebar.button("✨ Generate Itinerary"):
             except Exception as e:
                 st.error(f"An error occurred during itinerary generation: {e}")
 
+# --- Batch Job Polling ---
+# Runs as a fragment so only this block reruns on the poll timer and the rest of the page stays responsive.
+@st.fragment(run_every=BATCH_POLL_SECONDS)
+def poll_batch_job():
+    if 'batch_job' not in st.session_state:
+        return
+    batch_job = st.session_state.batch_job
+    # Only terminal job states and unusable results drop the job; a failed poll or
+    # submission is retried on the next tick since the job keeps running on Google's side.
+    try:
+        job = get_genai_client().batches.get(name=batch_job['name'])
+    except Exception as e:
+        st.warning(f"⚠️ Could not check the batch job ({e}). Retrying in {BATCH_POLL_SECONDS}s.")
+        return
+    job_state = job.state.name
+    if job_state not in _BATCH_DONE_STATES:
+        st.info(f"🕒 Batch job for {batch_job['inputs']['destination']} is {job_state.replace('JOB_STATE_', '').lower()} (stage {batch_job['stage']} of 2). Checking again every {BATCH_POLL_SECONDS}s; you can leave this page open.")
+        return
+    try:
+        if job_state != "JOB_STATE_SUCCEEDED":
+            raise RuntimeError(f"Batch job ended with state {job_state}. Please try again.")
+        stage_outputs = collect_batch_outputs(job, batch_job['task_keys'])
+    except Exception as e:
+        st.session_state.batch_error = f"An error occurred during batch itinerary generation: {e}"
+    else:
+        if batch_job['stage'] == 1:
+            if 'destination_analysis' in stage_outputs:
+                itinerary_cache.set(destination_analysis_cache_key(batch_job['inputs']['destination']), stage_outputs['destination_analysis'], expire=ITINERARY_CACHE_TTL_SECONDS)
+            try:
+                stage_2_name = submit_batch(['itinerary_generation'], batch_job['inputs'], {**batch_job['outputs'], **stage_outputs})
+            except Exception as e:
+                st.warning(f"⚠️ Could not submit the itinerary batch job ({e}). Retrying in {BATCH_POLL_SECONDS}s.")
+                return
+            batch_job['outputs'].update(stage_outputs)
+            batch_job['name'] = stage_2_name
+            batch_job['stage'] = 2
+            batch_job['task_keys'] = ['itinerary_generation']
+            st.info("🕒 Research finished; the itinerary batch job has been submitted.")
+            return
+        result = stage_outputs['itinerary_generation']
+        itinerary_cache.set(itinerary_cache_key(batch_job['inputs']), result, expire=ITINERARY_CACHE_TTL_SECONDS)
+        st.session_state.current_itinerary = result
+        st.session_state.original_inputs = batch_job['inputs']
+    del st.session_state.batch_job
+    st.rerun() # Full rerun so the itinerary (or error) renders outside this fragment
+
+if 'batch_error' in st.session_state:
+    st.error(st.session_state.pop('batch_error'))
+if 'batch_job' in st.session_state:
+    poll_batch_job()
+
 st.markdown("---")
 
 # --- Display Current Itinerary, Downloads, and Map (if exists in session_state) ---
@@ -217,8 +826,11 @@ if 'current_itinerary' in st.session_state and st.session_state.current_itinerar
     st.markdown(current_itinerary_text, unsafe_allow_html=True)
 
     # --- Helper function to convert Markdown to PDF ---
+    @st.cache_data(show_spinner=False)
     def convert_markdown_to_pdf(md_content):
-        html_content = markdown.markdown(md_content)
+        """Cached on the itinerary text so reruns from unrelated widgets don't rebuild the PDF."""
+        import markdown
+        html_content = markdown.markdown(md_content, extensions=['extra', 'sane_lists'])
         styled_html = f"""
         <html>
             <head>
@@ -231,71 +843,81 @@ if 'current_itinerary' in st.session_state and st.session_state.current_itinerar
             <body>{html_content}</body>
         </html>"""
         result = BytesIO()
-        pdf = pisa.CreatePDF(BytesIO(styled_html.encode('utf-8')), dest=result)
-        if not pdf.err:
+        try:
+            from weasyprint import HTML # C-backed (cairo/pango) renderer, much faster on long documents
+        except (ImportError, OSError):
+            HTML = None # Fallback to pure-Python xhtml2pdf if weasyprint or its system libraries are unavailable
+        if HTML is not None:
+            HTML(string=styled_html).write_pdf(target=result)
             return result.getvalue()
-        st.error(f"Error converting to PDF: {pdf.err}")
-        return None
+        from xhtml2pdf import pisa
+        pdf = pisa.CreatePDF(BytesIO(styled_html.encode('utf-8')), dest=result)
+        if pdf.err:
+            raise RuntimeError(pdf.err)
+        return result.getvalue()
 
     # --- Download Buttons ---
     st.markdown("---")
     file_name_dest = "".join(filter(str.isalnum, original_inputs_for_display['destination'])).lower()
     
-    # PDF Download
-    pdf_data = convert_markdown_to_pdf(current_itinerary_text)
-    if pdf_data:
-        st.download_button(
-            label="📥 Download Itinerary (PDF)",
-            data=pdf_data,
-            file_name=f"itinerary_{file_name_dest}_{original_inputs_for_display['duration_of_trip'].replace(' ', '_')}.pdf",
-            mime="application/pdf",
-        )
+    # PDF Download (built only once the user asks for it, then served from the cache)
+    if st.button("📄 Prepare PDF"):
+        st.session_state.pdf_requested_for = current_itinerary_text
+    if st.session_state.get('pdf_requested_for') == current_itinerary_text:
+        try:
+            with st.spinner("Preparing PDF..."):
+                pdf_data = convert_markdown_to_pdf(current_itinerary_text)
+        except Exception as pdf_e:
+            st.error(f"Error converting to PDF: {pdf_e}")
+            pdf_data = None
+        if pdf_data:
+            st.download_button(
+                label="📥 Download Itinerary (PDF)",
+                data=pdf_data,
+                file_name=f"itinerary_{file_name_dest}_{original_inputs_for_display['duration_of_trip'].replace(' ', '_')}.pdf",
+                mime="application/pdf",
+            )
+
+    # --- Helper function to render the Folium map to HTML (reused across reruns for the same points) ---
+    @st.cache_data(show_spinner=False)
+    def build_itinerary_map_html(points, center=None):
+        import folium
+
+        # Center map on the destination if known, otherwise on the first point
+        m = folium.Map(location=list(center or points[0][:2]), zoom_start=10)
+        for lat, lon, name in points:
+            folium.Marker([lat, lon], popup=name).add_to(m)
+        return m.get_root().render()
 
     # --- Map Display ---
     st.markdown("---")
     st.subheader("🗺️ Key Locations on Map")
+    from geopy.exc import GeocoderTimedOut, GeocoderUnavailable
     try:
-        key_locations_text = None
-        if "Key Locations for Map:" in current_itinerary_text:
-            key_locations_text = current_itinerary_text.split("Key Locations for Map:")[1].strip()
-            lines_to_parse = key_locations_text.split('\n')
-        else:
-            result_lines = current_itinerary_text.strip().split('\n')
-            lines_to_parse = result_lines[-10:] # Fallback
-
-        if lines_to_parse:
-            locations_to_map = []
-            for line in lines_to_parse:
-                cleaned_line = re.sub(r"^\s*[-*•\s]*", "", line).strip()
-                if cleaned_line and len(cleaned_line) > 3: # Basic check for valid location name
-                    locations_to_map.append(cleaned_line)
-            
-            if locations_to_map:
-                geolocator = Nominatim(user_agent="travel_planner_app/1.0")
-                map_points = []
-                for loc_name in locations_to_map:
-                    try:
-                        location_geo = geolocator.geocode(loc_name, timeout=10)
-                        if location_geo:
-                            map_points.append({
-                                "name": loc_name,
-                                "lat": location_geo.latitude,
-                                "lon": location_geo.longitude
-                            })
-                    except (GeocoderTimedOut, GeocoderUnavailable):
-                        st.warning(f"Could not geocode '{loc_name}' due to service issues. Skipping.")
-                    except Exception as geo_e:
-                        st.warning(f"Error geocoding '{loc_name}': {geo_e}. Skipping.")
-                
-                if map_points:
-                    # Center map on the first point or average if preferred
-                    m = folium.Map(location=[map_points[0]["lat"], map_points[0]["lon"]], zoom_start=10)
-                    for point in map_points:
-                        folium.Marker([point["lat"], point["lon"]], popup=point["name"]).add_to(m)
-                    st_folium(m, key="main_itinerary_map", width=725, height=500)
-                else:
-                    st.info("No locations could be geocoded for the map.")
+        geocode_fn, max_workers = build_geocode_fn()
+        map_points = [] # (lat, lon, name) in the itinerary's order
+        found_landmarks = False
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            resolved = executor.map(lambda landmark: resolve_landmark(landmark, geocode_fn), iter_landmarks(current_itinerary_text))
+            # Streamlit calls must stay on the script thread, so warnings are emitted here.
+            for loc_name, coords, geo_e in resolved:
+                found_landmarks = True
+                if isinstance(geo_e, (GeocoderTimedOut, GeocoderUnavailable)):
+                    st.warning(f"Could not geocode '{loc_name}' due to service issues. Skipping.")
+                elif geo_e:
+                    st.warning(f"Error geocoding '{loc_name}': {geo_e}. Skipping.")
+                elif coords:
+                    map_points.append((coords[0], coords[1], loc_name))
+
+        if found_landmarks:
+            if map_points:
+                # The map is display-only, so static HTML avoids st_folium's per-rerun state round-trip.
+                destination_center = lookup_known_coords(original_inputs_for_display['destination'], section="cities")
+                map_html = build_itinerary_map_html(tuple(map_points), destination_center)
+                components.html(map_html, width=725, height=500)
             else:
-                st.info("No key locations found in the itinerary for mapping.")
+                st.info("No locations could be geocoded for the map.")
+        else:
+            st.info("No key locations found in the itinerary for mapping.")
     except Exception as map_e:
-        st.error(f"An error occurred during map generation: {map_e}")
\ No newline at end of file
+        st.error(f"An error occurred during map generation: {map_e}")